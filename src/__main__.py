@@ -1,6 +1,6 @@
-import asyncio
+import uvloop
 
 from .main import main
 
 # Execute the Actor entrypoint.
-asyncio.run(main())
\ No newline at end of file
+uvloop.run(main())
\ No newline at end of file
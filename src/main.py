@@ -1,37 +1,334 @@
 import asyncio
+import contextlib
 import logging
+import random
 import httpx
 from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 from apify import Actor
 import datetime
-from urllib.parse import urljoin, urlparse
+import json
+from urllib.parse import parse_qsl, urlencode, urljoin, urlparse
 import os
 import openai
+import uvloop
+from tenacity import before_sleep_log, retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+def env_flag(name: str) -> bool:
+    """
+    Reads an opt-in boolean setting from the environment; only 1/true/yes turn it on.
+    """
+    return os.getenv(name, "").lower() in ("1", "true", "yes")
+
+def env_number(name: str, default: int | float, minimum: int | float, maximum: int | float | None = None) -> int | float:
+    """
+    Reads a numeric setting from the environment, parsed with the type of `default`.
+    Falls back to `default` if the value is unset or malformed, and clamps it to
+    [minimum, maximum].
+    """
+    raw = os.getenv(name)
+    try:
+        value = type(default)(raw) if raw is not None else default
+    except ValueError:
+        logging.warning(f"Ignoring malformed {name}={raw!r}; using {default}.")
+        value = default
+    value = max(minimum, value)
+    return min(maximum, value) if maximum is not None else value
+
+# System prompt for story generation. It must stay byte-identical across requests (no
+# timestamps or per-request values) and longer than 1024 tokens so that OpenAI's automatic
+# prompt caching can serve it from cache; only the article content varies per request.
+STORY_SYSTEM_PROMPT = (
+    "You are a helpful news reporter. You will be given one or more news articles, each "
+    "introduced by a bracketed number such as [1], [2], [3]. Based on each article's content, "
+    "write a detailed and comprehensive news story (around 500-800 words) that captures all the "
+    "main points, context, and implications. Focus on the core facts and provide a narrative. "
+    "Do not include a title, just the story body.\n\n"
+    "Output format:\n"
+    '- Return a single JSON object of the form {"stories": ["...", "..."]}.\n'
+    "- The \"stories\" array must contain exactly one string per numbered article, in the same "
+    "order as the articles are numbered. Never merge, skip, or reorder articles.\n"
+    "- Each string contains only the story body as plain text. Separate paragraphs with a blank "
+    "line. Do not use Markdown, headings, bullet points, bylines, datelines, or article numbers.\n"
+    "- If an article does not contain enough information for a full story, write the most "
+    "complete story the content supports rather than refusing or leaving the entry empty.\n\n"
+    "Style guide:\n"
+    "1. Lead. Open with a lead paragraph that answers who, what, when, where, and why in one or "
+    "two sentences. The most newsworthy fact comes first; background comes later.\n"
+    "2. Structure. Follow the inverted pyramid: the most important information at the top, "
+    "supporting details and quotes in the middle, and broader context, history, and "
+    "implications toward the end. Each paragraph should develop a single idea.\n"
+    "3. Accuracy. Use only facts, figures, names, dates, and quotes that appear in the article "
+    "content. Never invent quotes, sources, statistics, or events. If the article is ambiguous, "
+    "describe the ambiguity instead of resolving it with speculation.\n"
+    "4. Attribution. Attribute claims, opinions, and allegations to the person or organization "
+    "that made them, using neutral verbs such as \"said\", \"stated\", or \"according to\". "
+    "Distinguish clearly between established facts and claims that have not been verified.\n"
+    "5. Neutrality. Write in a neutral, impartial tone. Avoid loaded adjectives, editorializing, "
+    "sarcasm, and value judgements. When the article presents competing viewpoints, represent "
+    "each fairly and in proportion to the source material.\n"
+    "6. Quotes. Reproduce direct quotes exactly as they appear in the article, inside double "
+    "quotation marks, and only when they add information or voice. Paraphrase long or "
+    "repetitive quotes.\n"
+    "7. Names and titles. Give a person's full name and title on first reference and the "
+    "surname alone afterwards. Spell out the full name of an organization on first reference "
+    "before using a widely known abbreviation.\n"
+    "8. Numbers and dates. Spell out numbers one through nine and use numerals for 10 and "
+    "above, except for ages, percentages, and money, which always use numerals. Write dates as "
+    "they appear in the article; do not convert relative dates such as \"yesterday\" into "
+    "calendar dates.\n"
+    "9. Context. Where the article provides it, explain why the story matters, who is affected, "
+    "and what is expected to happen next. Do not add background knowledge that the article does "
+    "not contain.\n"
+    "10. Language. Use clear, concise sentences in the active voice and plain English. Avoid "
+    "jargon, cliches, and unnecessary adverbs. Define technical terms briefly when they first "
+    "appear.\n"
+    "11. Length. Aim for 500-800 words per story. Shorter source articles may produce shorter "
+    "stories, but never pad a story with repetition or filler to reach the target length.\n"
+    "12. Sensitive content. Describe violence, crime, and tragedy factually and without "
+    "graphic detail. Do not name victims of sexual crimes or minors accused of crimes, even if "
+    "the article does. Respect the presumption of innocence for people who have been accused "
+    "but not convicted.\n"
+    "13. Boilerplate. Ignore navigation text, advertisements, subscription prompts, cookie "
+    "notices, social media prompts, image captions without news value, and related-story links "
+    "that may appear in the article content.\n"
+    "14. Independence. Treat each numbered article independently. Do not carry facts, names, "
+    "or context from one article into the story for another, even if the articles appear to "
+    "cover related events.\n"
+    "15. Corrections and updates. If the article notes a correction, update, or developing "
+    "situation, reflect the most recent information in the body of the story and mention that "
+    "details may still change. Do not present superseded figures as current.\n"
+    "16. Opinion pieces. If an article is an opinion column, editorial, or analysis rather than "
+    "straight news, write the story about the argument being made: identify the author and "
+    "publication where given, summarize the main claims and the evidence offered for them, and "
+    "make clear throughout that these are the author's views rather than established facts.\n"
+    "17. Headlines and teasers. Some articles may consist of little more than a headline, a "
+    "teaser paragraph, or a paywall notice. In that case, write a short story covering only what "
+    "the available text states, and do not guess at the contents of the full article.\n"
+    "18. Geography and time zones. Name the city and, where it helps the reader, the state or "
+    "country on first reference to a location. Keep times in the time zone given by the article "
+    "and do not convert them.\n"
+    "19. Consistency. Use the same spelling for a name, place, or organization throughout a "
+    "story, following the spelling used in the article. Use American English spelling and "
+    "punctuation in all other text.\n"
+    "20. Final check. Before answering, verify that the JSON is valid, that the number of "
+    "stories equals the number of articles, and that every story follows this style guide."
+)
+
+# Selectors for the main headlines on the Drudge Report front page.
+HEADLINE_SELECTORS = ('a > b', 'font[size="+2"] a', 'font[size="+1"] a', 'a b')
+
+# Common selectors for main article content. You might need to refine this for specific sites.
+CONTENT_SELECTORS = (
+    'article', 'main', '.main-content', '#main-content', '.article-body',
+    'div[role="main"]', 'div.story-content', 'div.entry-content',
+    'div.post-content', 'div.content-body', 'body' # 'body' is a fallback, can be noisy
+)
+
+# Script, style, navigation, footer, header, and sidebar tags are removed to clean up article text
+UNWANTED_TAGS_SELECTOR = 'script, style, nav, footer, header, aside'
+
+# Small models are faster and cheaper for this task. An override must be a chat model that
+# supports JSON mode (response_format json_object), e.g. gpt-4o or gpt-3.5-turbo; plain gpt-4 doesn't.
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+# Enough output tokens for a 500-800 word story without truncating its end
+MAX_TOKENS_PER_STORY = 1100
+# Completion token limits of known models; requests above the limit are rejected outright
+MODEL_COMPLETION_LIMITS = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-4o': 16384,
+    'gpt-4o-mini': 16384,
+    'gpt-4.1': 32768,
+    'gpt-4.1-mini': 32768,
+    'gpt-4.1-nano': 32768,
+}
+# Upper bound on articles per OpenAI request (8 x 8000 characters of article content)
+MAX_STORY_BATCH_SIZE = 8
+# Upper bound on max_tokens for one request; unknown models get the conservative 4096
+MAX_COMPLETION_TOKENS = env_number("MAX_COMPLETION_TOKENS", MODEL_COMPLETION_LIMITS.get(OPENAI_MODEL, 4096), minimum=MAX_TOKENS_PER_STORY)
+
+# Upper bound on how much of an article page is downloaded before extracting its text.
+MAX_PAGE_BYTES = env_number("MAX_PAGE_BYTES", 2 * 1024 * 1024, minimum=64 * 1024)
+
+# Scraped hosts answering with these statuses are throttling us; back off and retry.
+RETRY_STATUS_CODES = frozenset({429, 503})
+MAX_HOST_RETRIES = 3
+MAX_RETRY_DELAY = 60
+
+# Query parameters that only track the click and don't change the page being linked to.
+TRACKING_QUERY_PARAMS = frozenset({'fbclid', 'gclid'})
+
 # --- Helper Functions for Stage 2 ---
 
-async def check_iframe_compatibility(url: str) -> bool:
+def normalize_url(url: str) -> str:
+    """
+    Normalizes a URL for deduplication: lowercases the scheme and host, drops the
+    fragment, and strips tracking query parameters (utm_*, fbclid, gclid).
+    """
+    parsed = urlparse(url)
+    query = urlencode([
+        (key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if not key.startswith('utm_') and key not in TRACKING_QUERY_PARAMS
+    ])
+    return parsed._replace(scheme=parsed.scheme.lower(), netloc=parsed.netloc.lower(), query=query, fragment='').geturl()
+
+def select_story_links(links: list[dict], drudge_url: str) -> list[dict]:
+    """
+    Returns the links that can lead to an external story: http(s) URLs on a host other
+    than Drudge's own, so mailto:/javascript: links and Drudge navigation are skipped.
+    """
+    drudge_domain = urlparse(drudge_url).hostname.removeprefix('www.')
+    story_links = []
+    for link_info in links:
+        parsed = urlparse(link_info["href"])
+        host = parsed.hostname or ''
+        if parsed.scheme in ('http', 'https') and host and host != drudge_domain and not host.endswith('.' + drudge_domain):
+            story_links.append(link_info)
+    return story_links
+
+def dedupe_links(links: list[dict]) -> list[dict]:
+    """
+    Returns the links with repeats removed, keeping the first occurrence of each normalized URL.
+    """
+    seen = set()
+    unique_links = []
+    for link_info in links:
+        key = normalize_url(link_info["href"])
+        if key not in seen:
+            seen.add(key)
+            unique_links.append(link_info)
+    return unique_links
+
+def create_http_client() -> httpx.AsyncClient:
+    """
+    Creates the HTTP client shared by every request in a run, so connections
+    (and HTTP/2 streams) are pooled and reused across hosts and stages.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        follow_redirects=True,
+        timeout=httpx.Timeout(15.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    )
+
+class HostRateLimiter:
+    """
+    Adaptive per-host concurrency limit (AIMD): a host's limit is halved whenever it
+    throttles us and grows by one after every `increase_every` successful responses.
+    """
+
+    def __init__(self, initial_limit: int = 8, max_limit: int = 32, increase_every: int = 10):
+        self.initial_limit = initial_limit
+        self.max_limit = max_limit
+        self.increase_every = increase_every
+        self._limits: dict[str, int] = {}
+        self._active: dict[str, int] = {}
+        self._successes: dict[str, int] = {}
+        self._conditions: dict[str, asyncio.Condition] = {}
+
+    def _condition(self, host: str) -> asyncio.Condition:
+        if host not in self._conditions:
+            self._limits[host] = self.initial_limit
+            self._active[host] = 0
+            self._successes[host] = 0
+            self._conditions[host] = asyncio.Condition()
+        return self._conditions[host]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, host: str):
+        """
+        Holds one of the host's concurrent request slots for the duration of the block.
+        """
+        condition = self._condition(host)
+        async with condition:
+            await condition.wait_for(lambda: self._active[host] < self._limits[host])
+            self._active[host] += 1
+        try:
+            yield
+        finally:
+            async with condition:
+                self._active[host] -= 1
+                condition.notify_all()
+
+    async def record_success(self, host: str) -> None:
+        condition = self._condition(host)
+        async with condition:
+            self._successes[host] += 1
+            if self._successes[host] >= self.increase_every and self._limits[host] < self.max_limit:
+                self._successes[host] = 0
+                self._limits[host] += 1
+                condition.notify_all()
+
+    async def record_throttle(self, host: str) -> None:
+        condition = self._condition(host)
+        async with condition:
+            self._successes[host] = 0
+            self._limits[host] = max(1, self._limits[host] // 2)
+            logging.warning(f"  Host '{host}' is throttling requests; concurrency limit lowered to {self._limits[host]}.")
+
+@contextlib.asynccontextmanager
+async def open_with_backoff(client: httpx.AsyncClient, host_limiter: HostRateLimiter, method: str, url: str, **kwargs):
+    """
+    Sends a streamed request through the per-host limiter and yields the response.
+    Responses with a status in RETRY_STATUS_CODES are retried with exponential backoff
+    (honouring Retry-After, capped at MAX_RETRY_DELAY seconds) up to MAX_HOST_RETRIES
+    times before being yielded as-is.
+    """
+    host = urlparse(url).hostname or url
+    for attempt in range(MAX_HOST_RETRIES + 1):
+        async with host_limiter.slot(host):
+            response = await client.send(client.build_request(method, url, **kwargs), stream=True)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_HOST_RETRIES:
+                try:
+                    yield response
+                finally:
+                    await response.aclose()
+                if response.is_success:
+                    await host_limiter.record_success(host)
+                return
+
+            await response.aclose()
+            await host_limiter.record_throttle(host)
+            retry_after = response.headers.get('Retry-After', '')
+            # Retry-After comes from an untrusted host, so it gets the same cap as our own backoff
+            delay = min(MAX_RETRY_DELAY, float(retry_after) if retry_after.isdigit() else 2 ** attempt + random.random())
+        logging.info(f"  Got {response.status_code} from {url}; retrying in {delay:.1f}s.")
+        await asyncio.sleep(delay)
+
+async def check_iframe_compatibility(url: str, client: httpx.AsyncClient, iframe_cache: dict[str, asyncio.Future], host_limiter: HostRateLimiter) -> bool:
     """
     Checks if a URL is likely to render in an iframe based on HTTP headers.
     Returns True if likely to render, False if likely to be blocked.
+
+    X-Frame-Options and CSP are set per site, so the result is cached per hostname in the
+    run's `iframe_cache` and concurrent checks for the same host share a single HEAD request.
+    """
+    host = urlparse(url).hostname or url
+    if host not in iframe_cache:
+        iframe_cache[host] = asyncio.ensure_future(_check_iframe_headers(url, client, host_limiter))
+    # Shield the shared check so one caller being cancelled doesn't cancel it for the others
+    return await asyncio.shield(iframe_cache[host])
+
+async def _check_iframe_headers(url: str, client: httpx.AsyncClient, host_limiter: HostRateLimiter) -> bool:
+    """
+    Issues a HEAD request for a URL and inspects its X-Frame-Options and CSP headers.
     """
     try:
-        async with httpx.AsyncClient(follow_redirects=True) as client:
-            response = await client.head(url, timeout=10)
+        async with open_with_backoff(client, host_limiter, "HEAD", url, timeout=10) as response:
             response.raise_for_status()
 
-            x_frame_options = response.headers.get('X-Frame-Options', '').lower()
-            if x_frame_options == 'deny' or x_frame_options == 'sameorigin':
-                logging.info(f"  URL '{url}' blocked by X-Frame-Options: {x_frame_options}")
-                return False
+        x_frame_options = response.headers.get('X-Frame-Options', '').lower()
+        if x_frame_options == 'deny' or x_frame_options == 'sameorigin':
+            logging.info(f"  URL '{url}' blocked by X-Frame-Options: {x_frame_options}")
+            return False
 
-            csp = response.headers.get('Content-Security-Policy', '')
-            if 'frame-ancestors' in csp:
-                if 'frame-ancestors \'none\'' in csp or 'frame-ancestors \'src\'' in csp:
-                     logging.info(f"  URL '{url}' likely blocked by CSP frame-ancestors.")
-                     return False
+        csp = response.headers.get('Content-Security-Policy', '')
+        if 'frame-ancestors' in csp:
+            if 'frame-ancestors \'none\'' in csp or 'frame-ancestors \'src\'' in csp:
+                 logging.info(f"  URL '{url}' likely blocked by CSP frame-ancestors.")
+                 return False
 
     except httpx.HTTPStatusError as e:
         logging.warning(f"  HTTP error checking iframe compatibility for {url}: {e.response.status_code}")
@@ -46,33 +343,40 @@ async def check_iframe_compatibility(url: str) -> bool:
     logging.info(f"  URL '{url}' seems iframe compatible (based on headers).")
     return True
 
-async def get_page_main_content(url: str) -> str:
+def extract_main_text(body: bytes, encoding: str) -> str:
     """
-    Fetches the content of a URL and attempts to extract the main article/body text.
+    Parses an HTML document and extracts the main article/body text.
     """
-    try:
-        async with httpx.AsyncClient(follow_redirects=True, timeout=30) as client:
-            response = await client.get(url)
-            response.raise_for_status()
+    tree = LexborHTMLParser(body.decode(encoding, errors='replace'))
 
-            soup = BeautifulSoup(response.text, 'html.parser')
+    for selector in CONTENT_SELECTORS:
+        node = tree.css_first(selector)
+        if node:
+            for unwanted_tag in node.css(UNWANTED_TAGS_SELECTOR):
+                unwanted_tag.decompose()
+            return node.text(separator=' ', strip=True)
 
-            # Common selectors for main article content. You might need to refine this for specific sites.
-            content_selectors = [
-                'article', 'main', '.main-content', '#main-content', '.article-body',
-                'div[role="main"]', 'div.story-content', 'div.entry-content',
-                'div.post-content', 'div.content-body', 'body' # 'body' is a fallback, can be noisy
-            ]
+    return tree.body.text(separator=' ', strip=True) if tree.body else ''
 
-            for selector in content_selectors:
-                element = soup.select_one(selector)
-                if element:
-                    # Remove script, style, navigation, footer, header, and sidebar tags to clean up text
-                    for unwanted_tag in element(['script', 'style', 'nav', 'footer', 'header', 'aside']):
-                        unwanted_tag.decompose()
-                    return element.get_text(separator=' ', strip=True)
+async def get_page_main_content(url: str, client: httpx.AsyncClient, host_limiter: HostRateLimiter) -> str:
+    """
+    Fetches the content of a URL and attempts to extract the main article/body text.
+    """
+    try:
+        # Stream the body and stop reading once MAX_PAGE_BYTES have arrived, so oversized
+        # pages (mostly inline scripts and markup after the article) don't inflate memory.
+        body = bytearray()
+        async with open_with_backoff(client, host_limiter, "GET", url, timeout=30) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                body += chunk
+                if len(body) >= MAX_PAGE_BYTES:
+                    logging.info(f"  Truncated content for {url} at {MAX_PAGE_BYTES} bytes.")
+                    break
+            encoding = response.encoding or 'utf-8'
 
-            return soup.body.get_text(separator=' ', strip=True) if soup.body else ''
+        # Parsing is CPU-bound, so it runs in a worker thread to keep the event loop free
+        return await asyncio.to_thread(extract_main_text, bytes(body), encoding)
 
     except httpx.HTTPStatusError as e:
         logging.error(f"  HTTP error fetching content for {url}: {e.response.status_code}")
@@ -84,122 +388,322 @@ async def get_page_main_content(url: str) -> str:
         logging.error(f"  Unexpected error getting content for {url}: {e}")
         return ""
 
-async def generate_story_with_openai(text_content: str, api_key: str) -> str:
+@retry(
+    retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)),
+    wait=wait_random_exponential(multiplier=1, max=60),
+    stop=stop_after_attempt(5),
+    before_sleep=before_sleep_log(logging.getLogger(), logging.WARNING),
+    reraise=True
+)
+async def stream_story_completion(client: openai.AsyncOpenAI, articles: str, story_count: int) -> tuple[str, str | None]:
+    """
+    Streams a story completion for the numbered articles and returns the joined content
+    together with the finish reason. Rate limits, connection errors and 5xx responses are
+    retried with jittered backoff.
+    """
+    stream = await client.chat.completions.create(
+        messages=[
+            {"role": "system", "content": STORY_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Article Content:\n{articles}"}
+        ],
+        model=OPENAI_MODEL,
+        temperature=0.7,
+        top_p=0.9,
+        max_tokens=min(MAX_TOKENS_PER_STORY * story_count, MAX_COMPLETION_TOKENS),
+        response_format={"type": "json_object"},
+        stream=True
+    )
+    parts = []
+    finish_reason = None
+    async for chunk in stream:
+        if chunk.choices:
+            parts.append(chunk.choices[0].delta.content or "")
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+    return "".join(parts), finish_reason
+
+def parse_stories(content: str) -> list[str]:
+    """
+    Parses the model's {"stories": [...]} response. Raises ValueError if the content is
+    not valid JSON or doesn't have that shape.
+    """
+    parsed = json.loads(content)
+    if not isinstance(parsed, dict):
+        raise ValueError(f"expected a JSON object, got {type(parsed).__name__}")
+    stories = parsed.get("stories")
+    if not isinstance(stories, list) or not all(isinstance(story, str) for story in stories):
+        raise ValueError('expected "stories" to be a list of strings')
+    return stories
+
+def max_story_batch_size() -> int:
+    """
+    Returns the largest batch whose stories all fit in MAX_COMPLETION_TOKENS, capped at
+    MAX_STORY_BATCH_SIZE to keep the articles well within the model's context window.
+    """
+    return max(1, min(MAX_STORY_BATCH_SIZE, MAX_COMPLETION_TOKENS // MAX_TOKENS_PER_STORY))
+
+async def generate_stories_with_openai(texts: list[str], api_key: str) -> list[str]:
     """
-    Sends text content to OpenAI's API to generate a detailed story.
+    Sends a batch of article texts to OpenAI's API in a single request and returns
+    one generated story per input text, aligned to the input order.
     """
-    if not text_content:
-        return "[No content to summarize/generate story from]"
+    stories = ["[No content to summarize/generate story from]"] * len(texts)
+    indices = [i for i, text_content in enumerate(texts) if text_content]
+    if not indices:
+        return stories
 
-    client = openai.AsyncOpenAI(api_key=api_key)
+    # Retries are handled by stream_story_completion, so the client's own are disabled
+    client = openai.AsyncOpenAI(api_key=api_key, max_retries=0)
 
-    # --- CHANGED: Prompt and input text limit for longer story ---
-    prompt = (
-        "Based on the following news article content, write a detailed and comprehensive "
-        "news story (around 500-800 words) that captures all the main "
-        "points, context, and implications. Focus on the core facts and provide a narrative. "
-        "Do not include a title, just the story body.\n\n"
-        f"Article Content:\n{text_content[:8000]}" # Increased input text limit to 8000 characters
+    articles = "\n\n".join(
+        f"[{n}]\n{texts[i][:8000]}" # Input text limit of 8000 characters per article
+        for n, i in enumerate(indices, start=1)
     )
 
     try:
-        chat_completion = await client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "You are a helpful news reporter."},
-                {"role": "user", "content": prompt}
-            ],
-            model="gpt-3.5-turbo", # Consider "gpt-4" for higher quality and better adherence to length, but at higher cost
-            temperature=0.7,
-            max_tokens=1000 # Increased max_tokens to allow for a longer generated story (approx 750 words)
-        )
-        return chat_completion.choices[0].message.content.strip()
+        content, finish_reason = await stream_story_completion(client, articles, len(indices))
+        if finish_reason == "length":
+            logging.error(f"  OpenAI response for a batch of {len(indices)} articles was cut off at max_tokens.")
+            error = "[OpenAI response truncated at max_tokens]"
+        else:
+            generated = parse_stories(content)
+            if len(generated) != len(indices):
+                logging.warning(f"  OpenAI returned {len(generated)} stories for a batch of {len(indices)} articles.")
+            for n, i in enumerate(indices):
+                stories[i] = generated[n].strip() if n < len(generated) else "[OpenAI response missing story]"
+            return stories
 
     except openai.APIConnectionError as e:
         logging.error(f"  OpenAI API connection error: {e}")
-        return "[OpenAI API connection error]"
+        error = "[OpenAI API connection error]"
     except openai.RateLimitError as e:
         logging.error(f"  OpenAI API rate limit exceeded: {e}")
-        return "[OpenAI API rate limit exceeded]"
+        error = "[OpenAI API rate limit exceeded]"
     except openai.APIStatusError as e:
         logging.error(f"  OpenAI API error (Status {e.status_code}): {e.response}")
-        return "[OpenAI API error]"
+        error = "[OpenAI API error]"
+    except ValueError as e: # Includes json.JSONDecodeError
+        logging.error(f"  Could not parse OpenAI response as JSON stories: {e}")
+        error = "[OpenAI response was not valid JSON]"
     except Exception as e:
         logging.error(f"  General error with OpenAI API: {e}")
-        return "[Error generating story with OpenAI]"
+        error = "[Error generating story with OpenAI]"
+
+    for i in indices:
+        stories[i] = error
+    return stories
+
+async def process_link(link_info: dict, sem: asyncio.Semaphore, client: httpx.AsyncClient, iframe_cache: dict[str, asyncio.Future], host_limiter: HostRateLimiter) -> str | None:
+    """
+    Runs the fetch half of the Stage 2 pipeline for a single Drudge link: iframe check
+    and content fetch. Returns None if the link can be shown in an iframe as-is.
+    Concurrency is bounded by `sem`.
+
+    Most Drudge links are expected to be iframe-incompatible, so while a host's iframe
+    compatibility is still unknown the content GET is started speculatively alongside
+    the header check and cancelled if it isn't needed.
+    """
+    url = link_info["href"]
+    async with sem:
+        # Only speculate while the host's result is unknown; a cached answer decides directly
+        cached = iframe_cache.get(urlparse(url).hostname or url)
+        if cached is not None and cached.done():
+            if cached.result():
+                return None
+            return await get_page_main_content(url, client, host_limiter)
+
+        iframe_task = asyncio.create_task(check_iframe_compatibility(url, client, iframe_cache, host_limiter))
+        content_task = asyncio.create_task(get_page_main_content(url, client, host_limiter))
+        try:
+            if await iframe_task:
+                return None
+            return await content_task
+        finally:
+            content_task.cancel()
+            iframe_task.cancel()
+
+async def process_story_batch(batch: list[tuple[dict, str]], llm_sem: asyncio.Semaphore, queue: asyncio.Queue, api_key: str) -> None:
+    """
+    Generates stories for a batch of (link_info, article_content) pairs with one
+    OpenAI request and queues them for the dataset. Concurrency is bounded by `llm_sem`.
+    """
+    async with llm_sem:
+        stories = await generate_stories_with_openai([content for _, content in batch], api_key)
 
+    scrape_timestamp = datetime.datetime.now().isoformat()
+    await queue.put([
+        {
+            "type": "story",
+            "text": link_info["text"],
+            "href": link_info["href"],
+            "story": story,
+            "scrape_timestamp": scrape_timestamp,
+            "position": link_info["position"]
+        }
+        for (link_info, _), story in zip(batch, stories)
+    ])
+
+async def dataset_writer(queue: asyncio.Queue) -> None:
+    """
+    Pushes records from the queue to the default dataset until cancelled, so producers
+    don't wait on Apify storage round-trips.
+    """
+    while True:
+        data = await queue.get()
+        try:
+            await Actor.push_data(data=data)
+        except Exception as e:
+            logging.error(f"  Error pushing data to the dataset: {e}")
+        finally:
+            queue.task_done()
+
+async def generate_stories(links: list[dict], client: httpx.AsyncClient, queue: asyncio.Queue, api_key: str) -> None:
+    """
+    Runs Stage 2 for the scraped Drudge links. Page fetches and OpenAI requests have
+    separate concurrency limits, and each batch of articles is sent to OpenAI as soon as
+    it fills up, so story generation overlaps with the remaining fetches.
+    """
+    # Values below 1 would deadlock the semaphores or never fill a batch, so clamp them
+    fetch_sem = asyncio.Semaphore(env_number("CONCURRENCY", 10, minimum=1))
+    llm_sem = asyncio.Semaphore(env_number("LLM_CONCURRENCY", 20, minimum=1))
+    # Several articles share one OpenAI request to amortize the fixed prompt cost. Batches are
+    # capped so every story's full token budget fits in a single completion.
+    batch_size = env_number("STORY_BATCH_SIZE", 4, minimum=1, maximum=max_story_batch_size())
+    # Iframe compatibility results and per-host rate limits only apply to this run
+    iframe_cache: dict[str, asyncio.Future] = {}
+    host_limiter = HostRateLimiter()
+
+    fetch_tasks = {
+        asyncio.create_task(process_link(link_info, fetch_sem, client, iframe_cache, host_limiter)): link_info
+        for link_info in links
+    }
+    story_tasks = []
+    articles = []
+    article_count = 0
+
+    pending = set(fetch_tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            link_info = fetch_tasks[task]
+            if task.exception() is not None:
+                logging.error(f"  Error processing {link_info['href']} in Stage 2: {task.exception()}")
+            elif task.result() is not None:
+                articles.append((link_info, task.result()))
+                article_count += 1
+
+        while len(articles) >= batch_size or (articles and not pending):
+            batch, articles = articles[:batch_size], articles[batch_size:]
+            story_tasks.append(asyncio.create_task(process_story_batch(batch, llm_sem, queue, api_key)))
+
+    logging.info(f"Generating stories for {article_count} articles in {len(story_tasks)} OpenAI requests...")
+    results = await asyncio.gather(*story_tasks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(f"  Error generating stories in Stage 2: {result}")
 
 # --- Main Actor Logic ---
 async def main():
+    if env_flag("LOOP_DEBUG"):
+        # Log any callback that blocks the event loop for longer than the threshold
+        loop = asyncio.get_running_loop()
+        loop.set_debug(True)
+        loop.slow_callback_duration = env_number("LOOP_DEBUG_THRESHOLD", 0.1, minimum=0.001)
+        logging.info(f"Event loop debug mode enabled (slow callback threshold {loop.slow_callback_duration}s).")
+
     async with Actor:
         logging.info("Starting Drudge Report Scraper (Beautiful Soup - Dedicated)...")
         drudge_url = "https://www.drudgereport.com/"
 
-        openai_api_key = os.getenv('OPENAI_API_KEY')
-        if not openai_api_key:
-            logging.error("OPENAI_API_KEY environment variable is not set. Cannot use OpenAI API.")
+        # Dataset writes go through a queue drained by a single writer task, which keeps
+        # the dataset in order: headlines, then links, then stories
+        queue = asyncio.Queue(maxsize=1000)
+        writer = asyncio.create_task(dataset_writer(queue))
 
-        # --- Stage 1: Scrape Drudge Report and save initial links ---
-        initial_drudge_links = []
         try:
-            async with httpx.AsyncClient() as client:
-                logging.info(f"Fetching Drudge Report from: {drudge_url}")
-                response = await client.get(drudge_url, timeout=15)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.text, 'html.parser')
-                logging.info("Drudge Report page fetched successfully.")
-
-            headline_selectors = ['a > b', 'font[size="+2"] a', 'font[size="+1"] a', 'a b']
-            extracted_headline_texts = set()
-
-            for selector in headline_selectors:
-                for element in soup.select(selector):
-                    text = element.get_text(strip=True)
-                    href = element.get('href')
-                    if text and text not in extracted_headline_texts:
-                        await Actor.push_data(data={
-                            "type": "headline",
-                            "text": text,
-                            "href": href,
-                            "scrape_timestamp": datetime.datetime.now().isoformat()
+            async with create_http_client() as client:
+                # --- Stage 1: Scrape Drudge Report and save initial links ---
+                initial_drudge_links = []
+                try:
+                    logging.info(f"Fetching Drudge Report from: {drudge_url}")
+                    response = await client.get(drudge_url, timeout=15)
+                    response.raise_for_status()
+                    soup = await asyncio.to_thread(BeautifulSoup, response.text, 'lxml')
+                    logging.info("Drudge Report page fetched successfully.")
+
+                    scrape_timestamp = datetime.datetime.now().isoformat()
+
+                    extracted_headline_texts = set()
+                    headlines = []
+
+                    for selector in HEADLINE_SELECTORS:
+                        for element in soup.select(selector):
+                            text = element.get_text(strip=True)
+                            if text and text not in extracted_headline_texts:
+                                headlines.append({
+                                    "type": "headline",
+                                    "text": text,
+                                    "href": element.get('href'),
+                                    "scrape_timestamp": scrape_timestamp
+                                })
+                                extracted_headline_texts.add(text)
+                    if headlines:
+                        await queue.put(headlines)
+                    logging.info(f"Extracted {len(extracted_headline_texts)} main headlines from Drudge.")
+                    if not extracted_headline_texts:
+                        logging.warning("WARNING: No main headlines extracted from Drudge. Check selectors.")
+
+                    # Scrape every <a> link and save the text and href, no exclusions or OpenAI processing
+                    extracted_link_count = 0
+                    links = []
+                    for link in soup.find_all('a', href=True):
+                        href = link['href']
+                        text = link.get_text(strip=True)
+
+                        if href.startswith('#'):
+                            continue
+                        # urljoin leaves absolute URLs unchanged and resolves relative ones
+                        absolute_href = urljoin(drudge_url, href)
+
+                        position = extracted_link_count + 1
+                        initial_drudge_links.append({"text": text, "href": absolute_href, "position": position})
+                        links.append({
+                            "type": "link",
+                            "text": text if text else f"[Link to {absolute_href}]",
+                            "href": absolute_href,
+                            "scrape_timestamp": scrape_timestamp,
+                            "position": position
                         })
-                        extracted_headline_texts.add(text)
-            logging.info(f"Extracted {len(extracted_headline_texts)} main headlines from Drudge.")
-            if not extracted_headline_texts:
-                logging.warning("WARNING: No main headlines extracted from Drudge. Check selectors.")
-
-            # Scrape every <a> link and save the text and href, no exclusions or OpenAI processing
-            extracted_link_count = 0
-            for link in soup.find_all('a', href=True):
-                href = link['href']
-                text = link.get_text(strip=True)
-
-                absolute_href = href
-                if href.startswith('http://') or href.startswith('https://') or href.startswith('//'):
-                    pass
-                elif href.startswith('#'):
-                    continue
-                else:
-                    absolute_href = urljoin(drudge_url, href)
-
-                position = extracted_link_count + 1
-                initial_drudge_links.append({"text": text, "href": absolute_href, "position": position})
-                await Actor.push_data(data={
-                    "type": "link",
-                    "text": text if text else f"[Link to {absolute_href}]",
-                    "href": absolute_href,
-                    "scrape_timestamp": datetime.datetime.now().isoformat(),
-                    "position": position
-                })
-                extracted_link_count += 1
-
-            logging.info(f"Extracted {extracted_link_count} Drudge links.")
-
-        except httpx.HTTPStatusError as e:
-            logging.error(f"HTTP error during main scrape of Drudge Report: {e.response.status_code} {e.response.reason_phrase}")
-        except httpx.RequestError as e:
-            logging.error(f"Network error during main scrape of Drudge Report: {e}")
-        except Exception as e:
-            logging.error(f"An unexpected error occurred during main scrape: {e}")
+                        extracted_link_count += 1
+                    if links:
+                        await queue.put(links)
+
+                    logging.info(f"Extracted {extracted_link_count} Drudge links.")
+
+                except httpx.HTTPStatusError as e:
+                    logging.error(f"HTTP error during main scrape of Drudge Report: {e.response.status_code} {e.response.reason_phrase}")
+                except httpx.RequestError as e:
+                    logging.error(f"Network error during main scrape of Drudge Report: {e}")
+                except Exception as e:
+                    logging.error(f"An unexpected error occurred during main scrape: {e}")
+
+                # --- Stage 2: Generate stories for links that won't render in an iframe ---
+                # Stage 2 fetches every linked page and makes paid OpenAI calls, so it is opt-in
+                if not env_flag("GENERATE_STORIES"):
+                    logging.info("Stage 2 story generation is disabled; set GENERATE_STORIES=1 to enable it.")
+                    return
+                openai_api_key = os.getenv('OPENAI_API_KEY')
+                if not openai_api_key:
+                    logging.error("OPENAI_API_KEY environment variable is not set. Cannot generate stories in Stage 2.")
+                    return
+
+                # Drudge links the same story several times; only process each URL once
+                stage_two_links = dedupe_links(select_story_links(initial_drudge_links, drudge_url))
+                logging.info(f"Processing {len(stage_two_links)} unique story links (of {len(initial_drudge_links)}) in Stage 2...")
+                await generate_stories(stage_two_links, client, queue, openai_api_key)
+                logging.info("Stage 2 processing complete.")
+        finally:
+            await queue.join()
+            writer.cancel()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    uvloop.run(main())